@@ -1,14 +1,18 @@
 #!/usr/bin/env python
 
 import os
+import pickle
 import re
 import shlex
+import shutil
 import subprocess
-from collections import Counter
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 from functools import cached_property, lru_cache
 from pathlib import Path
-from typing import ClassVar, Iterable
+from typing import Any, ClassVar, Iterable, Iterator, Mapping, NamedTuple, TypeVar
 
+import pydantic
 import tomllib
 import typer
 from pydantic import BaseModel, Field, ValidationError, field_validator
@@ -23,6 +27,10 @@ console = Console()
 state = {"verbose": False, "dry_run": False}
 
 APP_NAME = "pacbundle"
+IDENTIFIER_PATTERN = re.compile(R"^(g#|#)?[\w@.+-]+$")
+# Bump whenever the config models or their validators change.
+CONFIG_CACHE_VERSION = 1
+SHELL_METACHARACTERS = frozenset("|&;$`<>()[]{}*?~!#\\\n")
 
 
 class AbstractIdentifier(BaseModel):
@@ -60,35 +68,62 @@ class Bundle(BaseModel):
         for member in members:
             if not isinstance(member, str):
                 continue
-            pattern = R"^(g#|#)?[\w@.+-]+$"
-            if not re.match(pattern, member):
+            if not IDENTIFIER_PATTERN.match(member):
                 raise ValueError(f"Invalid identifier: {member}")
         return members
 
     @cached_property
     def normalized_members(self):
-        members: list[Identifier] = []
-        for member in self.members:
-            if isinstance(member, Identifier):
-                members.append(member)
-            elif member.startswith("g#"):
-                members.append(GroupIdentifier(group=member[2:]))
-            elif member.startswith("#"):
-                members.append(BundleIdentifier(bundle=member[1:]))
-            else:
-                members.append(PackageIdentifier(package=member))
-        return members
+        return [
+            member if isinstance(member, Identifier) else parse_identifier(member)
+            for member in self.members
+        ]
 
     @property
     def is_included(self):
         return self.include is not None and check_condition(self.include)
 
 
+@lru_cache(maxsize=None)
+def parse_identifier(member: str) -> Identifier:
+    if member.startswith("g#"):
+        return GroupIdentifier(group=member[2:])
+    if member.startswith("#"):
+        return BundleIdentifier(bundle=member[1:])
+    return PackageIdentifier(package=member)
+
+
+def split_simple_command(command: str) -> list[str] | None:
+    if not SHELL_METACHARACTERS.isdisjoint(command):
+        return None
+    try:
+        args = shlex.split(command)
+    except ValueError:
+        return None
+    if not args or shutil.which(args[0]) is None:
+        return None
+    return args
+
+
 @lru_cache
 def check_condition(condition: str):
+    args = split_simple_command(condition)
+    if args is not None:
+        try:
+            return subprocess.run(args, check=False).returncode == 0
+        except OSError:
+            pass
     return subprocess.run(condition, shell=True, check=False).returncode == 0
 
 
+def prefetch_conditions(conditions: Iterable[str]) -> None:
+    pending = set(conditions)
+    if len(pending) <= 1:
+        return
+    with ThreadPoolExecutor(max_workers=min(16, len(pending))) as executor:
+        list(executor.map(check_condition, pending))
+
+
 class Settings(BaseModel):
     install_command: str = "sudo pacman -S"
 
@@ -100,31 +135,131 @@ class Config(BaseModel):
 
 app_dir = Path(typer.get_app_dir(APP_NAME))
 config_path = app_dir / "config.toml"
+config_cache_path = app_dir / "config.cache.pkl"
+
+ConfigCacheKey = tuple[str, str, int, int]
+
+
+def load_cached_config(key: ConfigCacheKey) -> Config | None:
+    try:
+        with open(config_cache_path, "rb") as f:
+            cached_key, config = pickle.load(f)
+    except Exception:
+        return None
+    if cached_key != key or not isinstance(config, Config):
+        return None
+    return config
+
+
+def save_cached_config(key: ConfigCacheKey, config: Config) -> None:
+    temp_path = config_cache_path.with_name(f"{config_cache_path.name}.{os.getpid()}")
+    try:
+        with open(temp_path, "wb") as f:
+            pickle.dump((key, config), f)
+        os.replace(temp_path, config_cache_path)
+    except OSError:
+        temp_path.unlink(missing_ok=True)
+
+
+class ConfigSource(NamedTuple):
+    key: ConfigCacheKey
+    data: dict[str, Any]
+    cached_config: Config | None
 
 
 @lru_cache(1)
-def read_config() -> Config:
+def read_config_source() -> ConfigSource:
     try:
         with open(config_path, "rb") as f:
-            data = tomllib.load(f)
-            return Config.model_validate(data)
+            stat = os.fstat(f.fileno())
+            key = (
+                f"{CONFIG_CACHE_VERSION}-{pydantic.VERSION}",
+                str(config_path),
+                stat.st_mtime_ns,
+                stat.st_size,
+            )
+            cached_config = load_cached_config(key)
+            if cached_config is not None:
+                return ConfigSource(key, {}, cached_config)
+            return ConfigSource(key, tomllib.load(f), None)
     except FileNotFoundError:
         print("[red]Cannot find config file, exiting.[/red]")
         raise typer.Exit(1)
+    except Exception:
+        raise Exception
+
+
+ModelT = TypeVar("ModelT", bound=BaseModel)
+
+
+def validate_config(model: type[ModelT], data: Any) -> ModelT:
+    try:
+        return model.model_validate(data)
     except ValidationError as e:
         print(f"[red]The config file is invalid:\n{e}[/red]")
         raise typer.Exit(1)
-    except Exception:
-        raise Exception
 
 
-def pacman(*args: str) -> list[str]:
-    output = (
-        subprocess.run(["pacman", *args], capture_output=True, check=True)
-        .stdout.decode()
-        .split("\n")
-    )
-    return [line for line in output if line]
+@lru_cache(1)
+def read_config() -> Config:
+    source = read_config_source()
+    if source.cached_config is not None:
+        return source.cached_config
+    config = validate_config(Config, source.data)
+    save_cached_config(source.key, config)
+    return config
+
+
+class LazyBundles(Mapping[str, Bundle]):
+    def __init__(self, data: dict[str, Any]):
+        self.data = data
+        self.bundles: dict[str, Bundle] = {}
+
+    def __getitem__(self, name: str) -> Bundle:
+        if name not in self.bundles:
+            config = validate_config(Config, {"bundles": {name: self.data[name]}})
+            self.bundles[name] = config.bundles[name]
+        return self.bundles[name]
+
+    def __contains__(self, name: object) -> bool:
+        return name in self.data
+
+    def __iter__(self) -> Iterator[str]:
+        return iter(self.data)
+
+    def __len__(self) -> int:
+        return len(self.data)
+
+
+@lru_cache(1)
+def read_bundles() -> Mapping[str, Bundle]:
+    source = read_config_source()
+    if source.cached_config is not None:
+        return source.cached_config.bundles
+    bundles = source.data.get("bundles", {})
+    if not isinstance(bundles, dict):
+        return read_config().bundles
+    return LazyBundles(bundles)
+
+
+@lru_cache(1)
+def read_settings() -> Settings:
+    source = read_config_source()
+    if source.cached_config is not None:
+        return source.cached_config.settings
+    settings = source.data.get("settings", {})
+    return validate_config(Config, {"settings": settings}).settings
+
+
+def pacman(*args: str) -> Iterator[str]:
+    command = ["pacman", *args]
+    with subprocess.Popen(command, stdout=subprocess.PIPE, text=True) as process:
+        assert process.stdout is not None
+        for line in process.stdout:
+            if stripped := line.rstrip("\n"):
+                yield stripped
+    if process.returncode != 0:
+        raise subprocess.CalledProcessError(process.returncode, command)
 
 
 def run_action(*args: str) -> None:
@@ -135,80 +270,107 @@ def run_action(*args: str) -> None:
 
 
 @lru_cache(1)
-def pacman_groups() -> dict[str, set[str]]:
+def pacman_groups() -> dict[str, frozenset[str]]:
     group_output = pacman("-Qg")
-    groups: dict[str, set[str]] = {}
+    groups: dict[str, list[str]] = {}
     for line in group_output:
-        group_name, package_name = line.split()
+        group_name, _, package_name = line.partition(" ")
         if group_name not in groups:
-            groups[group_name] = set()
-        groups[group_name].add(package_name)
-    return groups
+            groups[group_name] = []
+        groups[group_name].append(package_name)
+    return {
+        group_name: frozenset(package_names)
+        for group_name, package_names in groups.items()
+    }
 
 
 @lru_cache(1)
-def get_explicitly_installed_packages() -> set[str]:
-    return set(line.split(" ")[0] for line in pacman("-Qe"))
+def get_explicitly_installed_packages() -> frozenset[str]:
+    return frozenset(pacman("-Qeq"))
 
 
 @lru_cache(1)
-def get_installed_packages() -> set[str]:
-    return set(line.split(" ")[0] for line in pacman("-Q"))
+def get_installed_packages() -> frozenset[str]:
+    return frozenset(pacman("-Qq"))
 
 
-def install_or_mark_explicit(packages: Iterable[str]):
-    config = read_config()
-    packages_to_install_or_mark_explicit = (
-        set(packages) - get_explicitly_installed_packages()
+def split_install_or_mark_explicit(
+    packages: Iterable[str],
+) -> tuple[set[str], set[str]]:
+    packages_to_install_or_mark_explicit = set(packages).difference(
+        get_explicitly_installed_packages()
+    )
+    if not packages_to_install_or_mark_explicit:
+        return set(), set()
+    installed_packages = get_installed_packages()
+    packages_to_install = packages_to_install_or_mark_explicit.difference(
+        installed_packages
     )
-    packages_to_install = (
-        packages_to_install_or_mark_explicit - get_installed_packages()
+    packages_to_mark_explicit = packages_to_install_or_mark_explicit.intersection(
+        installed_packages
     )
-    packages_to_mark_explicit = (
-        packages_to_install_or_mark_explicit & get_installed_packages()
+    return packages_to_install, packages_to_mark_explicit
+
+
+def install_packages(packages: Iterable[str]):
+    if packages := list(packages):
+        run_action(*read_settings().install_command.split(" "), *packages)
+
+
+def install_or_mark_explicit(packages: Iterable[str]):
+    packages_to_install, packages_to_mark_explicit = split_install_or_mark_explicit(
+        packages
     )
-    if packages_to_install:
-        run_action(*config.settings.install_command.split(" "), *packages_to_install)
-    if packages_to_mark_explicit:
-        run_action("sudo", "pacman", "-D", "--asexplicit", *packages_to_mark_explicit)
+    install_packages(packages_to_install)
+    set_install_reason(explicit=packages_to_mark_explicit)
 
 
-def mark_as_dependency(packages: Iterable[str]):
-    run_action("sudo", "pacman", "-D", "--asdeps", *packages)
+def set_install_reason(
+    explicit: Iterable[str] = (), dependencies: Iterable[str] = ()
+) -> None:
+    if dependencies := list(dependencies):
+        run_action("sudo", "pacman", "-D", "--asdeps", *dependencies)
+    if explicit := list(explicit):
+        run_action("sudo", "pacman", "-D", "--asexplicit", *explicit)
 
 
-def expand_bundles(bundle_names_to_search: Iterable[str], config: Config) -> set[str]:
+def expand_bundles(
+    bundle_names_to_search: Iterable[str], bundles: Mapping[str, Bundle]
+) -> set[str]:
     bundle_names: set[str] = set()
-    bundle_names_to_search = list(bundle_names_to_search)
-    while bundle_names_to_search:
-        bundle_name = bundle_names_to_search.pop()
+    stack = deque(bundle_names_to_search)
+    while stack:
+        bundle_name = stack.pop()
         if bundle_name in bundle_names:
             continue
-        if bundle_name not in config.bundles:
+        if bundle_name not in bundles:
             print(f"[red]There is no bundle called [bold]{bundle_name}[/bold][/red]")
             raise typer.Exit(1)
         bundle_names.add(bundle_name)
-        bundle = config.bundles[bundle_name]
+        bundle = bundles[bundle_name]
         for member in bundle.normalized_members:
-            if isinstance(member, BundleIdentifier) and member.is_passing_condition:
-                bundle_names_to_search.append(member.bundle)
+            if (
+                isinstance(member, BundleIdentifier)
+                and member.bundle not in bundle_names
+                and member.is_passing_condition
+            ):
+                stack.append(member.bundle)
     return bundle_names
 
 
-def get_packages(bundle: Bundle) -> list[str]:
-    packages: list[str] = []
+def get_packages(bundle: Bundle) -> Iterator[str]:
     for member in bundle.normalized_members:
         if not member.is_passing_condition:
             continue
         if isinstance(member, GroupIdentifier):
             group_name = member.group
-            if group_name not in pacman_groups():
-                print(f"[red]There is no bundle called [bold]{group_name}[/bold][/red]")
-                typer.Exit(1)
-            packages.extend(pacman_groups()[group_name])
+            group_packages = pacman_groups().get(group_name)
+            if group_packages is None:
+                print(f"[red]There is no group called [bold]{group_name}[/bold][/red]")
+                raise typer.Exit(1)
+            yield from group_packages
         elif isinstance(member, PackageIdentifier):
-            packages.append(member.package)
-    return packages
+            yield member.package
 
 
 def confirm_action(prompt: str = "Proceed with action?"):
@@ -217,12 +379,19 @@ def confirm_action(prompt: str = "Proceed with action?"):
     typer.confirm(prompt, abort=True)
 
 
+def get_specified_bundle_names(config: Config) -> set[str]:
+    prefetch_conditions(
+        bundle.include
+        for bundle in config.bundles.values()
+        if bundle.include is not None
+    )
+    return {name for name, bundle in config.bundles.items() if bundle.is_included}
+
+
 def get_all_specified_packages():
     config = read_config()
-    specified_bundle_names = {
-        name for name, bundle in config.bundles.items() if bundle.is_included
-    }
-    all_bundle_names = expand_bundles(specified_bundle_names, config)
+    specified_bundle_names = get_specified_bundle_names(config)
+    all_bundle_names = expand_bundles(specified_bundle_names, config.bundles)
     all_packages = {
         package
         for bundle_name in all_bundle_names
@@ -231,6 +400,14 @@ def get_all_specified_packages():
     return all_packages
 
 
+def get_specified_packages_difference():
+    all_packages = get_all_specified_packages()
+    installed_packages = get_explicitly_installed_packages()
+    installed_but_not_specified = installed_packages - all_packages
+    specified_but_not_installed = all_packages - installed_packages
+    return installed_but_not_specified, specified_but_not_installed
+
+
 @app.callback()
 def main(
     verbose: Annotated[bool, typer.Option("--verbose", "-v")] = False,
@@ -245,30 +422,29 @@ def main(
 @app.command("list", help="List the bundles in the configuration file.")
 def list_packages():
     config = read_config()
-    specified_bundle_names = {
-        name for name, bundle in config.bundles.items() if bundle.is_included
-    }
-    all_bundle_names = expand_bundles(specified_bundle_names, config)
+    specified_bundle_names = get_specified_bundle_names(config)
+    all_bundle_names = expand_bundles(specified_bundle_names, config.bundles)
     table = Table("Bundle", "Child Bundles", "Packages", "Included")
     for bundle_name, bundle in config.bundles.items():
-        child_bundles = (
-            member.bundle
-            for member in bundle.members
-            if isinstance(member, BundleIdentifier)
-        )
-        packages_count = Counter(
-            member.identifier_type for member in bundle.normalized_members
-        )
-        packages_count_str = f"{packages_count['package']} packages"
-        if packages_count["group"]:
-            packages_count_str += f"\n{packages_count['group']} groups"
+        child_bundles: list[str] = []
+        package_count = group_count = 0
+        for member in bundle.normalized_members:
+            if isinstance(member, BundleIdentifier):
+                child_bundles.append(member.bundle)
+            elif isinstance(member, GroupIdentifier):
+                group_count += 1
+            else:
+                package_count += 1
+        packages_count_str = f"{package_count} packages"
+        if group_count:
+            packages_count_str += f"\n{group_count} groups"
         table.add_row(
             bundle_name,
             ", ".join(child_bundles),
             packages_count_str,
             (
                 "✓"
-                if bundle.is_included
+                if bundle_name in specified_bundle_names
                 else "○"
                 if bundle_name in all_bundle_names
                 else "✖"
@@ -283,15 +459,15 @@ def list_packages():
     help="Compare the difference between of packages in included bundles and those installed in the system.",
 )
 def compare_packages_difference():
-    all_packages = get_all_specified_packages()
-    installed_packages = get_explicitly_installed_packages()
-    installed_but_not_specified = installed_packages - all_packages
+    (
+        installed_but_not_specified,
+        specified_but_not_installed,
+    ) = get_specified_packages_difference()
     if installed_but_not_specified:
         print(
             f"There are {len(installed_but_not_specified)} packages are explicitly installed but not specified in included bundles"
         )
         print(Columns(installed_but_not_specified, equal=True, expand=True))
-    specified_but_not_installed = all_packages - installed_packages
     if specified_but_not_installed:
         print(
             f"There are {len(specified_but_not_installed)} packages are specified in included bundles but not explicitly installed"
@@ -303,17 +479,15 @@ def compare_packages_difference():
 
 @app.command("sync", help="Sync system installation with included bundles")
 def sync_packages():
-    all_packages = get_all_specified_packages()
-    installed_packages = get_explicitly_installed_packages()
-    installed_but_not_specified = installed_packages - all_packages
-    specified_but_not_installed = all_packages - installed_packages
-
+    (
+        installed_but_not_specified,
+        specified_but_not_installed,
+    ) = get_specified_packages_difference()
     if installed_but_not_specified:
         print(
             f"The following {len(installed_but_not_specified)} packages will be unmarked as explicitly installed."
         )
         print(Columns(installed_but_not_specified, equal=True, expand=True))
-    specified_but_not_installed = all_packages - installed_packages
     if specified_but_not_installed:
         print(
             f"The following {len(specified_but_not_installed)} packages will be installed"
@@ -323,26 +497,31 @@ def sync_packages():
         print("Nothing to do")
         raise typer.Exit()
     confirm_action()
+    packages_to_install, packages_to_mark_explicit = split_install_or_mark_explicit(
+        specified_but_not_installed
+    )
+    set_install_reason(
+        explicit=packages_to_mark_explicit, dependencies=installed_but_not_specified
+    )
     if installed_but_not_specified:
-        mark_as_dependency(installed_but_not_specified)
         print(
             "Remember to run [italic]pacman -Rsn $(pacman -Qdtq) to clean up unused dependencies[/italic]"
         )
-    if specified_but_not_installed:
-        install_or_mark_explicit(specified_but_not_installed)
+    install_packages(packages_to_install)
 
 
 @app.command("install", help="Install a bundle")
 def install_bundle(name: Annotated[str, typer.Argument(help="Name of the bundle")]):
-    config = read_config()
-    if name not in config.bundles:
+    read_settings()
+    bundles = read_bundles()
+    if name not in bundles:
         print(f"[red]Bundle {name} does not exist in config.[/red]")
         raise typer.Exit(1)
-    all_bundle_names = expand_bundles([name], config)
+    all_bundle_names = expand_bundles([name], bundles)
     all_packages = {
         package
         for bundle_name in all_bundle_names
-        for package in get_packages(config.bundles[bundle_name])
+        for package in get_packages(bundles[bundle_name])
     }
     packages_to_install_or_mark_explicit = (
         all_packages - get_explicitly_installed_packages()